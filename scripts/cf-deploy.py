@@ -1,6 +1,11 @@
 from typing import TypedDict, Iterable, Reversible
-from threading import Thread
-from time import sleep
+from functools import lru_cache
+from os import stat
+from json import loads
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from time import sleep, monotonic
+from random import uniform
 from sys import exit
 from sys import stdout as STDOUT
 
@@ -8,6 +13,8 @@ import logging
 
 try:
     import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError, EndpointConnectionError
     from colorama import Fore, Style
 except ImportError:
     print(f"boto3 or colorama is not installed for your interpreter.")
@@ -19,17 +26,72 @@ logging.basicConfig(stream=STDOUT)
 logger.setLevel(logging.INFO)
 
 REGION = "ap-northeast-2"
-client = boto3.client("cloudformation", region_name=REGION)
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cfn")
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def cfn_client(region=REGION):
+    # Created on first use and shared by every thread in the process. The lock
+    # keeps pool workers racing on the first call from each building a client.
+    client = _clients.get(region)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(region)
+            if client is None:
+                client = _clients[region] = _build_client(region)
+
+    return client
+
+
+def _build_client(region):
+    # Pool sized above the worker count so polling and stack calls never queue on
+    # connections; adaptive retries back off on CloudFormation throttling.
+    return boto3.Session().client(
+        "cloudformation",
+        config=Config(
+            region_name=region,
+            max_pool_connections=32,
+            retries={"mode": "adaptive", "max_attempts": 10},
+        ),
+    )
 
 
 def get_template_body(path: str) -> str:
-    with open(path, "r") as f:
-        body = f.read()
+    # Keyed on mtime so an edited template is re-read within the same run.
+    return _read_template(path, stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _read_template(path: str, mtime: int) -> str:
+    # Read raw bytes and decode once; only the decoded body is kept.
+    with open(path, "rb") as f:
+        body = f.read().decode("utf-8")
     return body
 
 
+def backoff_delays(base=2, cap=30):
+    """Yield decorrelated-jitter delays: first ~base, then up to 3x the previous one."""
+    delay = base
+    while True:
+        yield delay
+        delay = min(cap, uniform(base, delay * 3))
+
+
+THROTTLING_ERRORS = {"Throttling", "ThrottlingException", "RequestLimitExceeded"}
+
+
+def is_retryable(error: Exception) -> bool:
+    # botocore has already retried these; the stack poller keeps polling
+    # through them until the wait deadline instead of failing every waiter.
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Code"] in THROTTLING_ERRORS
+    return isinstance(error, EndpointConnectionError)
+
+
 def create_stack(stack: dict) -> TypedDict:
-    response = client.create_stack(
+    response = cfn_client().create_stack(
         StackName=stack["StackName"],
         TemplateBody=stack["TemplateBody"],
         Parameters=stack["Parameters"],
@@ -39,7 +101,7 @@ def create_stack(stack: dict) -> TypedDict:
 
 
 def update_stack(stack: dict) -> TypedDict:
-    response = client.update_stack(
+    response = cfn_client().update_stack(
         StackName=stack["StackName"],
         TemplateBody=stack["TemplateBody"],
         Parameters=stack["Parameters"],
@@ -49,28 +111,224 @@ def update_stack(stack: dict) -> TypedDict:
 
 
 def delete_stack(stack_name) -> None:
-    client.delete_stack(StackName=stack_name)
+    cfn_client().delete_stack(StackName=stack_name)
     return None
 
 
+@lru_cache(maxsize=None)
 def get_template_summary(template_body):
-    response = client.get_template_summary(TemplateBody=template_body)
+    # Identical bodies are summarized once; callers must not mutate the response.
+    response = cfn_client().get_template_summary(TemplateBody=template_body)
     return response
 
 
-def wait_stack(operation, stack_name, delay=5, max_attempts=120):
-    waiter = client.get_waiter(operation)
+def is_stack_unchanged(stack: dict) -> bool:
+    response = cfn_client().describe_stacks(StackName=stack["StackName"])
+    current = response["Stacks"][0]
+    current_params = {
+        param["ParameterKey"]: param.get("ParameterValue")
+        for param in current.get("Parameters", [])
+    }
+    parameter_keys = {param["ParameterKey"] for param in stack["Parameters"]}
+    if parameter_keys != current_params.keys():
+        return False
+    for param in stack["Parameters"]:
+        if not param["UsePreviousValue"] and (
+            param["ParameterValue"] != current_params[param["ParameterKey"]]
+        ):
+            return False
+
+    template = cfn_client().get_template(
+        StackName=stack["StackName"], TemplateStage="Original"
+    )["TemplateBody"]
+    if not isinstance(template, str):
+        # boto3 returns JSON templates already parsed
+        try:
+            return template == loads(stack["TemplateBody"])
+        except ValueError:
+            return False
+
+    return template == stack["TemplateBody"]
+
+
+# Operation -> (statuses that complete the wait, statuses that fail it), as in
+# the botocore waiter definitions. A stack missing from the listing has status
+# None: deleted, which ends a delete wait and fails the others, like the
+# ValidationError botocore's waiters fail on.
+WAIT_STATES = {
+    "stack_create_complete": (
+        {"CREATE_COMPLETE"},
+        {
+            "CREATE_FAILED",
+            "DELETE_COMPLETE",
+            "DELETE_FAILED",
+            "ROLLBACK_FAILED",
+            "ROLLBACK_COMPLETE",
+            None,
+        },
+    ),
+    "stack_update_complete": (
+        {"UPDATE_COMPLETE"},
+        {
+            "UPDATE_FAILED",
+            "UPDATE_ROLLBACK_FAILED",
+            "UPDATE_ROLLBACK_COMPLETE",
+            None,
+        },
+    ),
+    "stack_delete_complete": (
+        {"DELETE_COMPLETE", None},
+        {
+            "DELETE_FAILED",
+            "CREATE_FAILED",
+            "ROLLBACK_FAILED",
+            "UPDATE_ROLLBACK_IN_PROGRESS",
+            "UPDATE_ROLLBACK_FAILED",
+            "UPDATE_ROLLBACK_COMPLETE",
+            "UPDATE_COMPLETE",
+        },
+    ),
+}
+
+
+class StackWaitError(Exception):
+    pass
+
+
+class StackMonitor:
+    """Wait on many stacks with a single DescribeStacks listing per poll."""
+
+    def __init__(self, base_delay=2, max_delay=30):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = Lock()
+        self._pending = {}
+        self._poller = None
+        self._reset_delay = False
+
+    def wait(self, operation, stack_name, max_wait=600):
+        success, failures = WAIT_STATES[operation]
+        waiter = {
+            "operation": operation,
+            "success": success,
+            "failures": failures,
+            "deadline": monotonic() + max_wait,
+            "event": Event(),
+            "error": None,
+        }
+
+        with self._lock:
+            # Several threads may wait on the same stack; each gets its own Event.
+            self._pending.setdefault(stack_name, []).append(waiter)
+            self._reset_delay = True
+            if self._poller is None:
+                self._poller = Thread(target=self._poll, daemon=True)
+                self._poller.start()
+
+        waiter["event"].wait()
+        if waiter["error"]:
+            raise waiter["error"]
+
+        return True
+
+    def _describe_statuses(self, stack_names):
+        # Stop paging as soon as every pending stack has been seen; a deleted
+        # stack is only known to be gone after the full listing.
+        paginator = cfn_client().get_paginator("describe_stacks")
+        remaining = set(stack_names)
+        statuses = {}
+        for page in paginator.paginate():
+            for stack in page["Stacks"]:
+                if stack["StackName"] in remaining:
+                    statuses[stack["StackName"]] = stack["StackStatus"]
+                    remaining.discard(stack["StackName"])
+            if not remaining:
+                break
+
+        return statuses
+
+    def _poll(self):
+        delays = backoff_delays(self.base_delay, self.max_delay)
+        while True:
+            with self._lock:
+                if self._reset_delay:
+                    delays = backoff_delays(self.base_delay, self.max_delay)
+                    self._reset_delay = False
+            sleep(next(delays))
+            with self._lock:
+                stack_names = set(self._pending)
+
+            try:
+                statuses = self._describe_statuses(stack_names)
+                error = None
+            except Exception as e:
+                statuses, error = None, e
+                if is_retryable(e):
+                    logger.warning(f"Polling stacks failed ({e}), retrying")
+                    error = None
+
+            with self._lock:
+                for stack_name, waiters in list(self._pending.items()):
+                    # Registered after the listing was requested: not queried, so
+                    # its missing status does not mean deleted. Check next poll.
+                    if stack_name not in stack_names:
+                        continue
+                    for waiter in list(waiters):
+                        if error is None:
+                            done, waiter["error"] = self._check(
+                                stack_name, waiter, statuses
+                            )
+                        else:
+                            done, waiter["error"] = True, error
+
+                        if done:
+                            waiters.remove(waiter)
+                            waiter["event"].set()
+                    if not waiters:
+                        del self._pending[stack_name]
+
+                if not self._pending:
+                    self._poller = None
+                    return
+
+    def _check(self, stack_name, waiter, statuses):
+        # statuses is None when this poll failed transiently; only the deadline applies.
+        if statuses is not None:
+            status = statuses.get(stack_name)
+            if status in waiter["success"]:
+                return True, None
+            if status in waiter["failures"]:
+                return True, StackWaitError(
+                    f"{stack_name} failed {waiter['operation']}: "
+                    f"{status or 'stack does not exist'}"
+                )
+        if monotonic() > waiter["deadline"]:
+            return True, TimeoutError(
+                f"{stack_name} did not reach {waiter['operation']} in time"
+            )
+        return False, None
 
-    waiter.wait(
-        StackName=stack_name, WaiterConfig={"Delay": delay, "MaxAttempts": max_attempts}
-    )
 
-    return True
+monitor = StackMonitor()
+
+
+def wait_stack(operation, stack_name, max_wait=600):
+    return monitor.wait(operation, stack_name, max_wait=max_wait)
+
+
+def load_template(path):
+    template_body = get_template_body(path)
+    return template_body, get_template_summary(template_body)
+
+
+def load_templates(paths: Iterable[str]) -> dict:
+    """Read and summarize each unique template concurrently, filling both caches."""
+    paths = list(dict.fromkeys(paths))
+    return dict(zip(paths, EXECUTOR.map(load_template, paths)))
 
 
 def build_template(stack_name, template_path, user_parameters: dict):
-    template_body = get_template_body(template_path)
-    summary = get_template_summary(template_body)
+    template_body, summary = load_template(template_path)
 
     parameters = []
     for parameter in summary["Parameters"]:
@@ -91,13 +349,24 @@ def build_template(stack_name, template_path, user_parameters: dict):
         "StackName": stack_name,
         "TemplateBody": template_body,
         "Parameters": parameters,
-        "Capabilities": summary.get("Capabilities", []),
+        "Capabilities": list(summary.get("Capabilities", [])),
     }
 
     return stack
 
 
-def deploy_in_order(stacks: Iterable[dict], method=create_stack):
+def wait_all(futures):
+    # Let every job finish and log each failure, then re-raise the first one,
+    # so one failed sequence neither hides nor abandons the others.
+    wait_futures(futures)
+    errors = [future.exception() for future in futures if future.exception()]
+    for error in errors:
+        logger.error(error, exc_info=error)
+    if errors:
+        raise errors[0]
+
+
+def deploy_stack(stack: dict, method=create_stack):
     if method == create_stack:
         wait_operation = "stack_create_complete"
         message = "created"
@@ -107,85 +376,140 @@ def deploy_in_order(stacks: Iterable[dict], method=create_stack):
     else:
         raise ValueError(method)
 
-    try:
-        for stack in stacks:
-            response = method(stack)
-            stack["StackId"] = response["StackId"]
-            logger.info(f"{stack['StackName']} is being {message}")
+    if method == update_stack and is_stack_unchanged(stack):
+        logger.info(f"{stack['StackName']} is unchanged, skipping update")
+        return stack
+
+    response = method(stack)
+    stack["StackId"] = response["StackId"]
+    logger.info(f"{stack['StackName']} is being {message}")
 
-            wait_stack(wait_operation, stack["StackName"])
-            logger.info(f"{stack['StackName']} is {message}")
-    except Exception as e:
-        logger.error(e)
+    wait_stack(wait_operation, stack["StackName"])
+    logger.info(f"{stack['StackName']} is {message}")
+
+    return stack
+
+
+def deploy_in_order(stacks: Iterable[dict], method=create_stack):
+    for stack in stacks:
+        deploy_stack(stack, method)
 
     return stacks
 
 
 def deploy_parallel(stack_sequences: Iterable[Iterable[dict]], method=create_stack):
-    jobs = []
-    for stacks in stack_sequences:
-        job = Thread(target=deploy_in_order, args=[stacks, method], daemon=True)
-        job.start()
+    futures = [
+        EXECUTOR.submit(deploy_in_order, stacks, method) for stacks in stack_sequences
+    ]
+    wait_all(futures)
 
-        jobs.append(job)
+    return stack_sequences
 
-    while list(filter(lambda job: job.is_alive(), jobs)):
-        sleep(1)
 
-    return stack_sequences
+def deploy_waves(waves: Iterable[Iterable[dict]], method=create_stack):
+    """Deploy every stack of a wave at once; a wave starts after the previous one is done."""
+    for stacks in waves:
+        futures = [EXECUTOR.submit(deploy_stack, stack, method) for stack in stacks]
+        wait_all(futures)
 
+    return waves
 
-def delete_in_reverse_order(stacks: Reversible[dict]):
-    try:
-        for param in reversed(stacks):
-            delete_stack(param["StackName"])
-            logger.info(f"{param['StackName']} is being deleted")
 
-            wait_stack("stack_delete_complete", param["StackName"])
-            param.pop("StackId", None)
-            logger.info(f"{param['StackName']} is deleted")
-    except Exception as e:
-        logger.error(e)
+def delete_stack_and_wait(stack: dict):
+    delete_stack(stack["StackName"])
+    logger.info(f"{stack['StackName']} is being deleted")
 
-    return stacks
+    wait_stack("stack_delete_complete", stack["StackName"])
+    stack.pop("StackId", None)
+    logger.info(f"{stack['StackName']} is deleted")
+
+    return stack
 
 
-def delete_parallel(stack_sequences: Iterable[Iterable[dict]]):
-    jobs = []
-    for stacks in stack_sequences:
-        job = Thread(target=delete_in_reverse_order, args=[stacks], daemon=True)
-        job.start()
-        jobs.append(job)
+def delete_in_reverse_order(stacks: Reversible[dict], dependencies: dict = None):
+    """Delete stacks last to first, or by `dependencies` (stack name -> names it needs).
 
-    while list(filter(lambda job: job.is_alive(), jobs)):
-        sleep(1)
+    With dependencies, every stack that no remaining stack needs is deleted
+    concurrently, then the next round starts.
+    """
+    if dependencies is None:
+        for stack in reversed(stacks):
+            delete_stack_and_wait(stack)
+        return stacks
+
+    remaining = {stack["StackName"]: stack for stack in stacks}
+    while remaining:
+        needed = {dep for name in remaining for dep in dependencies.get(name, ())}
+        ready = [stack for name, stack in remaining.items() if name not in needed]
+        if not ready:
+            raise ValueError(f"Circular dependencies between {', '.join(remaining)}")
+
+        # A private pool: this usually runs on an EXECUTOR worker already.
+        with ThreadPoolExecutor(max_workers=len(ready)) as pool:
+            list(pool.map(delete_stack_and_wait, ready))
+        for stack in ready:
+            del remaining[stack["StackName"]]
+
+    return stacks
+
+
+def delete_parallel(
+    stack_sequences: Iterable[Iterable[dict]], dependencies: dict = None
+):
+    futures = [
+        EXECUTOR.submit(delete_in_reverse_order, stacks, dependencies)
+        for stacks in stack_sequences
+    ]
+    wait_all(futures)
 
     return stack_sequences
 
 
+SEQUENCE_FORMAT = f"{Fore.WHITE}===== Stack sequence {{}} ====={Fore.RESET}"
+STACK_FORMAT = f"{Fore.LIGHTGREEN_EX}{{}}{Fore.RESET}"
+STACK_CAPABILITIES_FORMAT = (
+    f"{Fore.LIGHTGREEN_EX}{Style.BRIGHT}{{}}\t{{}}{Fore.RESET}{Style.RESET_ALL}"
+)
+PARAMETER_FORMAT = (
+    f"\t{Fore.LIGHTBLACK_EX}{{}}: "
+    f"{Fore.WHITE}{Style.BRIGHT}{{}}{Fore.RESET}{Style.RESET_ALL}"
+)
+PREVIOUS_VALUE_FORMAT = f"\t{Fore.LIGHTBLACK_EX}Use previous value: {{}}{Fore.RESET}"
+
+
 def describe_sequence(stack_sequences: Iterable[Iterable[dict]]):
+    lines = []
     for num, stacks in enumerate(stack_sequences, start=1):
-        print(f"{Fore.WHITE}===== Stack sequence {num} ====={Fore.RESET}")
+        lines.append(SEQUENCE_FORMAT.format(num))
 
         for stack in stacks:
-            print(
-                f"{Fore.LIGHTGREEN_EX}{Style.BRIGHT}{stack['StackName']}\t{stack['Capabilities']}{Fore.RESET}{Style.RESET_ALL}"
+            lines.append(
+                STACK_CAPABILITIES_FORMAT.format(
+                    stack["StackName"], stack["Capabilities"]
+                )
                 if stack["Capabilities"]
-                else f"{Fore.LIGHTGREEN_EX}{stack['StackName']}"
+                else STACK_FORMAT.format(stack["StackName"])
             )
             not_specified_params = []
             for param in stack["Parameters"]:
                 if param["UsePreviousValue"]:
                     not_specified_params.append(param["ParameterKey"])
                 else:
-                    print(
-                        f"\t{Fore.LIGHTBLACK_EX}{param['ParameterKey']}: {Fore.WHITE}{Style.BRIGHT}{param['ParameterValue']}{Fore.RESET}{Style.RESET_ALL}"
+                    lines.append(
+                        PARAMETER_FORMAT.format(
+                            param["ParameterKey"], param["ParameterValue"]
+                        )
                     )
             if not_specified_params:
-                print(
-                    f"\t{Fore.LIGHTBLACK_EX}Use previous value: {', '.join(not_specified_params)}{Fore.RESET}"
+                lines.append(
+                    PREVIOUS_VALUE_FORMAT.format(", ".join(not_specified_params))
                 )
 
+    # One write instead of one per line
+    lines.append("")
+    STDOUT.write("\n".join(lines))
+    STDOUT.flush()
+
     return
 
 
@@ -211,10 +535,18 @@ if __name__ == "__main__":
     ARTIFACT_BUCKET = "wsi-hmoon-artifacts"
     CODECOMMIT_BRANCH = "main"
 
+    TEMPLATES = {
+        "codecommit": TEMPLATE_DIRECTORY + "blue-green/codecommit.yaml",
+        "codebuild": TEMPLATE_DIRECTORY + "blue-green/codebuild.yaml",
+        "codedeploy": TEMPLATE_DIRECTORY + "blue-green/codedeploy.yaml",
+        "codepipeline": TEMPLATE_DIRECTORY + "blue-green/codepipeline.yaml",
+        "vpc": TEMPLATE_DIRECTORY + "vpc_data_subnet.yaml",
+    }
+
     codecommit_stack = (
         build_template(
             stack_name=f"dev-{app_name}-git",
-            template_path=TEMPLATE_DIRECTORY + "blue-green/codecommit.yaml",
+            template_path=TEMPLATES["codecommit"],
             user_parameters={"RepositoryName": f"dev-{app_name}"},
         )
         for app_name in apps
@@ -223,7 +555,7 @@ if __name__ == "__main__":
     codebuild_stack = (
         build_template(
             stack_name=f"dev-{app_name}-build",
-            template_path=TEMPLATE_DIRECTORY + "blue-green/codebuild.yaml",
+            template_path=TEMPLATES["codebuild"],
             user_parameters={
                 "CodeBuildProjectName": f"dev-{app_name}-build",
                 "CodeCommitRepositoryName": f"dev-{app_name}",
@@ -238,7 +570,7 @@ if __name__ == "__main__":
     codedeploy_stack = (
         build_template(
             stack_name=f"dev-{app_name}-deploy",
-            template_path=TEMPLATE_DIRECTORY + "blue-green/codedeploy.yaml",
+            template_path=TEMPLATES["codedeploy"],
             user_parameters={
                 "CodeDeployApplicationName": f"dev-{app_name}-deploy",
                 "ECSServiceName": app_name,
@@ -252,7 +584,7 @@ if __name__ == "__main__":
     codepipeline_stack = (
         build_template(
             stack_name=f"{REGION}-{app_name}-pipeilne",
-            template_path=TEMPLATE_DIRECTORY + "blue-green/codepipeline.yaml",
+            template_path=TEMPLATES["codepipeline"],
             user_parameters={
                 "CodePipelineName": f"dev-{app_name}-pipeline",
                 "CodeCommitRepositoryName": f"dev-{app_name}",
@@ -269,33 +601,55 @@ if __name__ == "__main__":
     vpc_stack = (
         build_template(
             stack_name=f"vpc",
-            template_path=TEMPLATE_DIRECTORY + "vpc_data_subnet.yaml",
+            template_path=TEMPLATES["vpc"],
             user_parameters={"NamePrefix": "wsi"},
         )
         for _ in range(1)
     )
 
-    try:
-        ### Defining stacks as generator is recommended for lazy evaluation.
-        ### If you want to reference stacks later, convert to list here.
-        # codepipeline_stack = list(codepipeline_stack)
-
-        sequences = list(
-            zip(
-                # codecommit_stack,
-                # codebuild_stack,
-                # codedeploy_stack,
-                # codepipeline_stack,
-                vpc_stack,
-            )
+    ### Each template is read and summarized once, concurrently, and reused for every app.
+    ### Leave out templates that are not deployed.
+    load_templates(TEMPLATES[name] for name in ["vpc"])
+
+    ### Defining stacks as generator is recommended for lazy evaluation.
+    ### If you want to reference stacks later, convert to list here.
+    # codepipeline_stack = list(codepipeline_stack)
+
+    sequences = list(
+        zip(
+            # codecommit_stack,
+            # codebuild_stack,
+            # codedeploy_stack,
+            # codepipeline_stack,
+            vpc_stack,
         )
+    )
 
-        ### Describe stacks before deployment
-        describe_sequence(sequences)
-        check_user_admission()
-
-        ### Execute
-        delete_parallel(sequences)
-        # deploy_parallel(sequences, method=update_stack)
-    except Exception as e:
-        logger.error(e)
+    ### Stacks of the same stage do not depend on each other across apps.
+    ### Deploying stage by stage runs each stage for all apps at once.
+    # waves = [
+    #     list(codecommit_stack),
+    #     list(codebuild_stack),
+    #     list(codedeploy_stack),
+    #     list(codepipeline_stack),
+    # ]
+
+    ### Describe stacks before deployment
+    describe_sequence(sequences)
+    check_user_admission()
+
+    ### Execute
+    delete_parallel(sequences)
+    # delete_parallel(
+    #     sequences,
+    #     dependencies={
+    #         f"{REGION}-{app_name}-pipeilne": {
+    #             f"dev-{app_name}-git",
+    #             f"dev-{app_name}-build",
+    #             f"dev-{app_name}-deploy",
+    #         }
+    #         for app_name in apps
+    #     },
+    # )
+    # deploy_parallel(sequences, method=update_stack)
+    # deploy_waves(waves, method=create_stack)
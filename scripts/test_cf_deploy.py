@@ -0,0 +1,292 @@
+import importlib.util
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("colorama")
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+spec = importlib.util.spec_from_file_location(
+    "cf_deploy", Path(__file__).with_name("cf-deploy.py")
+)
+cf_deploy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cf_deploy)
+
+
+class FakeCloudFormation:
+    """Stacks stay DELETE_IN_PROGRESS for `polls` listings after delete_stack."""
+
+    def __init__(self, polls=20):
+        self.polls = polls
+        self.stacks = {}
+        self.deleted_while_listed = []
+        self.lock = threading.Lock()
+
+    def delete_stack(self, StackName):
+        with self.lock:
+            self.stacks[StackName] = self.polls
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self):
+        with self.lock:
+            for name, polls in list(self.stacks.items()):
+                if polls:
+                    self.stacks[name] = polls - 1
+                else:
+                    del self.stacks[name]
+            stacks = [
+                {"StackName": name, "StackStatus": "DELETE_IN_PROGRESS"}
+                for name in self.stacks
+            ]
+        yield {"Stacks": stacks}
+
+    def is_listed(self, name):
+        with self.lock:
+            return name in self.stacks
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    client = FakeCloudFormation()
+    monkeypatch.setattr(cf_deploy, "cfn_client", lambda region=None: client)
+    monkeypatch.setattr(
+        cf_deploy, "monitor", cf_deploy.StackMonitor(base_delay=0.01, max_delay=0.01)
+    )
+    return client
+
+
+def test_staggered_deletes_wait_until_stack_is_gone(fake):
+    returned_early = []
+
+    def delete(name, delay):
+        time.sleep(delay)
+        cf_deploy.delete_stack_and_wait({"StackName": name})
+        if fake.is_listed(name):
+            returned_early.append(name)
+
+    jobs = [
+        threading.Thread(target=delete, args=[name, delay])
+        for name, delay in [("first", 0), ("second", 0.05)]
+    ]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+
+    assert returned_early == []
+
+
+def test_dependencies_are_deleted_after_their_dependents(fake):
+    delete_stack = fake.delete_stack
+    dependencies = {"pipeline": {"build", "deploy"}, "build": {"git"}}
+    dependents = {"git": {"build"}, "build": {"pipeline"}, "deploy": {"pipeline"}}
+
+    def checked_delete(StackName):
+        for dependent in dependents.get(StackName, ()):
+            if fake.is_listed(dependent):
+                fake.deleted_while_listed.append((StackName, dependent))
+        delete_stack(StackName=StackName)
+
+    fake.delete_stack = checked_delete
+    stacks = [{"StackName": name} for name in ["git", "build", "deploy", "pipeline"]]
+
+    cf_deploy.delete_in_reverse_order(stacks, dependencies)
+
+    assert fake.deleted_while_listed == []
+    assert fake.stacks == {}
+
+
+def test_concurrent_waits_on_the_same_stack_all_return(fake):
+    fake.delete_stack(StackName="shared")
+    jobs = [
+        threading.Thread(
+            target=cf_deploy.wait_stack,
+            args=["stack_delete_complete", "shared"],
+            daemon=True,
+        )
+        for _ in range(2)
+    ]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join(timeout=5)
+
+    assert not any(job.is_alive() for job in jobs)
+
+
+def test_concurrent_first_calls_build_one_client(monkeypatch):
+    built = []
+
+    class Session:
+        def client(self, *args, **kwargs):
+            time.sleep(0.05)
+            built.append(object())
+            return built[-1]
+
+    monkeypatch.setattr(cf_deploy.boto3, "Session", Session)
+    monkeypatch.setattr(cf_deploy, "_clients", {})
+
+    clients = list(cf_deploy.EXECUTOR.map(lambda _: cf_deploy.cfn_client(), range(8)))
+
+    assert len(built) == 1
+    assert all(client is built[0] for client in clients)
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "DescribeStacks")
+
+
+def test_is_retryable():
+    assert cf_deploy.is_retryable(client_error("Throttling"))
+    assert not cf_deploy.is_retryable(client_error("ValidationError"))
+
+
+def test_poller_keeps_polling_through_throttling(fake):
+    paginate = fake.paginate
+    errors = [client_error("Throttling"), client_error("Throttling")]
+
+    def throttled():
+        if errors:
+            raise errors.pop()
+        return paginate()
+
+    fake.paginate = throttled
+    fake.delete_stack(StackName="throttled")
+
+    assert cf_deploy.wait_stack("stack_delete_complete", "throttled")
+    assert errors == []
+    assert not fake.is_listed("throttled")
+
+
+def test_poller_raises_permanent_errors_at_once(fake):
+    def invalid():
+        raise client_error("ValidationError")
+
+    fake.paginate = invalid
+    fake.delete_stack(StackName="invalid")
+
+    with pytest.raises(ClientError):
+        cf_deploy.wait_stack("stack_delete_complete", "invalid")
+    assert fake.is_listed("invalid")
+
+
+def test_wait_all_logs_every_failure(caplog):
+    def fail(name):
+        raise ValueError(name)
+
+    futures = [cf_deploy.EXECUTOR.submit(fail, name) for name in ["a", "b", "c"]]
+
+    with pytest.raises(ValueError, match="a"):
+        cf_deploy.wait_all(futures)
+    assert [record.getMessage() for record in caplog.records] == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize(
+    "operation", ["stack_create_complete", "stack_update_complete"]
+)
+def test_waiting_on_a_missing_stack_fails(fake, operation):
+    with pytest.raises(cf_deploy.StackWaitError, match="does not exist"):
+        cf_deploy.wait_stack(operation, "missing", max_wait=5)
+
+
+class FakeExistingStack:
+    """One deployed stack, as DescribeStacks and GetTemplate report it."""
+
+    def __init__(self, template, parameters):
+        self.template = template
+        self.parameters = parameters
+        self.updates = []
+
+    def describe_stacks(self, StackName):
+        parameters = [
+            {"ParameterKey": key, "ParameterValue": value}
+            for key, value in self.parameters.items()
+        ]
+        return {"Stacks": [{"StackName": StackName, "Parameters": parameters}]}
+
+    def get_template(self, StackName, TemplateStage):
+        return {"TemplateBody": self.template}
+
+    def update_stack(self, **kwargs):
+        self.updates.append(kwargs["StackName"])
+        return {"StackId": kwargs["StackName"]}
+
+
+def stack_params(template, **values):
+    # A value of None keeps the deployed value (UsePreviousValue)
+    parameters = []
+    for key, value in values.items():
+        if value is None:
+            parameters.append({"ParameterKey": key, "UsePreviousValue": True})
+        else:
+            parameters.append(
+                {
+                    "ParameterKey": key,
+                    "ParameterValue": value,
+                    "UsePreviousValue": False,
+                }
+            )
+    return {
+        "StackName": "app",
+        "TemplateBody": template,
+        "Parameters": parameters,
+        "Capabilities": [],
+    }
+
+
+@pytest.fixture
+def existing(monkeypatch):
+    client = FakeExistingStack("Resources: {}\n", {"Name": "app", "Size": "1"})
+    monkeypatch.setattr(cf_deploy, "cfn_client", lambda region=None: client)
+    return client
+
+
+def test_identical_stack_is_not_updated(existing):
+    stack = stack_params("Resources: {}\n", Name="app", Size=None)
+
+    assert cf_deploy.is_stack_unchanged(stack)
+    cf_deploy.deploy_stack(stack, cf_deploy.update_stack)
+    assert existing.updates == []
+
+
+def test_changed_parameter_value_is_updated(existing):
+    assert not cf_deploy.is_stack_unchanged(
+        stack_params("Resources: {}\n", Name="app", Size="2")
+    )
+
+
+def test_new_template_parameter_is_updated(existing):
+    assert not cf_deploy.is_stack_unchanged(
+        stack_params("Resources: {}\n", Name="app", Size="1", Extra="x")
+    )
+
+
+def test_changed_template_body_is_updated(existing):
+    assert not cf_deploy.is_stack_unchanged(
+        stack_params("Resources: {Bucket: {}}\n", Name="app", Size="1")
+    )
+
+
+def test_json_template_is_compared_structurally(existing):
+    existing.template = {"Resources": {}, "Outputs": {}}
+
+    assert cf_deploy.is_stack_unchanged(
+        stack_params('{"Outputs": {}, "Resources": {}}', Name="app", Size="1")
+    )
+    assert not cf_deploy.is_stack_unchanged(
+        stack_params('{"Resources": {}}', Name="app", Size="1")
+    )
+
+
+def test_masked_noecho_parameter_is_updated(existing):
+    existing.parameters["Size"] = "****"
+
+    assert not cf_deploy.is_stack_unchanged(
+        stack_params("Resources: {}\n", Name="app", Size="1")
+    )